@@ -11,48 +11,124 @@ Translated from the original tensorflow repo:
 Many thanks to the original authors.
 """
 from datetime import datetime
+import math
+from typing import Optional
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from config import (SEQ_LENGTH,DEVICE,GEN_NUM_EPOCH,MAXINT,openLog)
+from torch.utils.data import TensorDataset, DataLoader, BatchSampler, SequentialSampler
+from config import (SEQ_LENGTH,DEVICE,GEN_HIDDEN_DIM,GEN_NUM_EPOCH,MAXINT,openLog)
 from data_processing import read_sampleFile
 from lstmCore import pretrain_LSTMCore
 
+LOG_EPS = math.log(1e-20)
+
+@torch.jit.script
+def gumbel_sample(logits, generator: Optional[torch.Generator] = None):
+    ''' draw one token per row from softmax(logits), without the softmax:
+        argmax(logits + Gumbel(0,1) noise) follows the same distribution
+        and needs only a single pass over the vocabulary.
+    '''
+    # -log(-log(u)), all in place on the freshly drawn uniform noise.
+    gumbel = torch.rand(logits.shape, generator=generator, dtype=logits.dtype, device=logits.device)
+    gumbel = gumbel.clamp_(1e-20, 1.0).log_().neg_().log_().neg_()
+    return (logits + gumbel).argmax(dim=-1)
+
+@torch.jit.script
+def sample_loop(start, hx, cx, emb, w_ih, w_hh, b_ih, b_hh, proj_w, proj_b, ignored, seq_len: int, maxint: int,
+                generator: Optional[torch.Generator] = None):
+    ''' autoregressive sampling for the generator. the lstm cell is written out
+        as plain tensor ops (same gate order as nn.LSTMCell), so that torchscript
+        can compile the whole loop and fuse the pointwise gate operations.
+        nn.LSTM itself cannot be scripted here.
+    '''
+    # preallocated output, written column by column: O(seq_len) instead of
+    #   re-concatenating the growing sample tensor at every step.
+    y_all_sample = torch.empty(start.shape[0], seq_len, dtype=torch.int32, device=start.device)
+    y_all_sample[:,0] = start
+    # avoid choosing the ignored tokens: their projection bias is replaced by
+    #   -maxint once, so the masked logits come out of the projection itself
+    #   (a logit of w.h - maxint instead of exactly -maxint, which makes no 
+    #   difference for sampling). no separate masking pass per step.
+    masked_proj_b = proj_b.index_fill(0, ignored, -maxint)
+    for i in range(seq_len-1):
+        embeds = F.embedding(y_all_sample[:,i], emb)
+        gates = torch.mm(embeds, w_ih.t()) + b_ih + torch.mm(hx, w_hh.t()) + b_hh
+        ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+        ingate = torch.sigmoid(ingate)
+        forgetgate = torch.sigmoid(forgetgate)
+        cellgate = torch.tanh(cellgate)
+        outgate = torch.sigmoid(outgate)
+        cx = forgetgate * cx + ingate * cellgate
+        hx = outgate * torch.tanh(cx)
+        tag_space = torch.addmm(masked_proj_b, hx, proj_w.t())
+        # random choice based on probability distribution. another possibility would be to take the max.
+        y_all_sample[:,i+1] = gumbel_sample(tag_space, generator).to(torch.int32)
+    return y_all_sample
+
 class Generator(nn.Module):
     def __init__(self, pretrain_model=None, start_token=0, 
-                 ignored_tokens=None):
+                 ignored_tokens=None, seed=None):
         super().__init__()
         self.start_token = start_token
         self.ignored_tokens = ignored_tokens
+        # index tensor of the ignored tokens, to mask them in one index_fill_.
+        #   a (non-persistent) buffer, so that it follows the generator's .to().
+        self.register_buffer('_ignored_idx', torch.tensor(ignored_tokens or [], dtype=torch.long, device=DEVICE),
+                             persistent=False)
+        # dedicated random number generator for sampling, instead of the global one.
+        #   without a seed it is seeded from the global rng, so that
+        #   torch.manual_seed still makes the sampling reproducible.
+        if seed is None:
+            seed = int(torch.randint(2**62, (1,)))
+        self._gen = torch.Generator(device=DEVICE)
+        self._gen.manual_seed(seed)
         if pretrain_model is None:
             x, _, reverse_vocab, _ = read_sampleFile()
             self.pretrain_model, _ = pretrain_LSTMCore(train_x=x, vocab_size=len(reverse_vocab))
         else:
             self.pretrain_model = pretrain_model       
-        self.softmax = nn.Softmax(dim=2)
+        # compile the lstmCore in place for the training forward pass, where all
+        #   minibatches share the shape (batch_size, SEQ_LENGTH). the module tree
+        #   and state_dict are unchanged. sampling does not go through the nn.LSTM at all.
+        self.pretrain_model.compile(mode='reduce-overhead', dynamic=False)
         self.loss = GeneratorLoss()
 
-    def forward(self, x, hidden, rewards, ignored_tokens=None, sentence_lengths=None):
-        ''' forward pass. variables can be backpropagated. '''
+    def forward(self, x, hidden, rewards, ignored_tokens=None, sentence_lengths=None, lstmCore=None,
+                return_probs=False):
+        ''' forward pass. variables can be backpropagated. 
+            lstmCore optionally replaces self.pretrain_model for this call
+            (e.g. a traced copy sharing its parameters).
+            the output probabilities are only computed if return_probs,
+            otherwise None is returned in their place.
+        '''
         if ignored_tokens is None:
             ignored_tokens = self.ignored_tokens
-        y, tag_space = self.pretrain_model(x, hidden, sentence_lengths=sentence_lengths)
+        if lstmCore is None:
+            lstmCore = self.pretrain_model
+        # lstm and vocab projection in bfloat16 on gpu. the log probabilities
+        #   are computed in fp32 from the logits.
+        with torch.autocast(device_type=DEVICE.type, dtype=torch.bfloat16,
+                            enabled=(DEVICE.type == 'cuda')):
+            if sentence_lengths is None:
+                y, tag_space = lstmCore(x, hidden)
+            else:
+                y, tag_space = lstmCore(x, hidden, sentence_lengths=sentence_lengths)
         y = y.data
-        y_pred = self.ignoreTokens(tag_space, ignored_tokens)
-        y_prob = self.softmax(y_pred)
-        shape = (y_prob.shape[0], y_prob.shape[1])
-        try:
-            y_output = y_prob.view(-1,y_prob.shape[-1]).multinomial(num_samples=1).view(shape)
-        except RuntimeError:
-            print('error with multinomial. using argmax instead.')
-            y_output = torch.argmax(y_prob.view(-1,y_prob.shape[-1]), dim=1).view(shape)
+        y_pred = self.ignoreTokens(tag_space.float(), ignored_tokens)
+        # log_softmax directly, instead of log(softmax) inside the loss.
+        y_logprob = F.log_softmax(y_pred, dim=2)
+        y_prob = None
+        if return_probs:
+            y_prob = y_logprob.data.exp()
+        y_output = gumbel_sample(y_pred.data, self.samplingGenerator())
         if rewards is None:
-            rewards = y_prob.sum(dim=2).data
-        loss_variable = self.loss(y_prob, x, rewards)
+            rewards = torch.ones(x.shape, device=x.device)
+        loss_variable = self.loss(y_logprob, x, rewards)
         return y_output, y_prob, loss_variable
 
     def generate(self, start_token=None, ignored_tokens=None, batch_size=1):
-        ''' the generate_LSTMCore only generates samples under torch.no_grad,
+        ''' the generate_LSTMCore only generates samples under torch.inference_mode,
             therefore it will not be backpropagated.
         '''
         if start_token is None:
@@ -63,20 +139,28 @@ class Generator(nn.Module):
         return y_all_sample
     
     def generate_LSTMCore(self, start_token, ignored_tokens, batch_size=1):
-        y = [start_token] * batch_size
-        y_all_sample = torch.tensor(y,device=DEVICE).int().view(-1,1)
-        with torch.no_grad():
-            hidden = self.pretrain_model.module.init_hidden(len(y))
-            for i in range(SEQ_LENGTH-1):
-                x = torch.tensor(y,device=DEVICE).view([-1,1])
-                y_pred, tag_space = self.pretrain_model(x,hidden,sentence_lengths=torch.tensor([1],device=DEVICE).long())
-                # random choice based on probability distribution. another possibility would be to take the max.
-                y_prob = F.softmax(self.ignoreTokens(tag_space, ignored_tokens), dim=2)
-                shape = (y_prob.shape[0], y_prob.shape[1])
-                y = y_prob.view(-1,y_prob.shape[-1]).multinomial(num_samples=1).float().view(shape)
-                y_all_sample = torch.cat([y_all_sample,y.int()],dim=1)
+        # sampling steps through the weights of the lstmCore's (single layer)
+        #   nn.LSTM inside the torchscript sample_loop, instead of re-running
+        #   the full (packed) nn.LSTM on every token.
+        lstmCore = self.pretrain_model.module
+        lstm = lstmCore.lstm
+        start = torch.full((batch_size,), start_token, dtype=torch.long, device=DEVICE)
+        ignored = self.ignoredIndex(ignored_tokens)
+        with torch.inference_mode():
+            # reshape the (batch_size, 1, hidden_dim) states for the lstm cell:
+            hx, cx = [h.view(-1,GEN_HIDDEN_DIM) for h in lstmCore.init_hidden(batch_size)]
+            y_all_sample = sample_loop(start, hx, cx, lstmCore.embedding.weight,
+                                       lstm.weight_ih_l0, lstm.weight_hh_l0, lstm.bias_ih_l0, lstm.bias_hh_l0,
+                                       lstmCore.hidden2tag.weight, lstmCore.hidden2tag.bias,
+                                       ignored, SEQ_LENGTH, MAXINT, self.samplingGenerator())
         return y_all_sample
     
+    def samplingGenerator(self):
+        ''' the dedicated random number generator for sampling. generators
+            pickled without one sample from the global rng (None).
+        '''
+        return getattr(self, '_gen', None)
+
     def ignoreTokens(self, original, ignored_tokens):
         ''' avoid probability of choosing the 'START' or 'END' tokens.
             only call this function in generator and rollout modules. 
@@ -84,29 +168,39 @@ class Generator(nn.Module):
         '''
         if ignored_tokens is None:
             return original
-        for token in ignored_tokens:
-            if len(original.shape)==3:
-                original[:,:,token] = -MAXINT
-            else:
-                original[:,token] = -MAXINT
-        return original
+        # the index follows the input's device, e.g. for DataParallel replicas
+        #   of the rollout module on other gpus.
+        ignored = self.ignoredIndex(ignored_tokens).to(original.device)
+        return original.index_fill_(-1, ignored, -MAXINT)
+
+    def ignoredIndex(self, ignored_tokens):
+        ''' ignored tokens as a long tensor on DEVICE. the generator's own
+            ignored_tokens are converted once and reused (generators pickled
+            without the cached index fall back to converting per call).
+        '''
+        if ignored_tokens is self.ignored_tokens:
+            ignored_idx = getattr(self, '_ignored_idx', None)
+            if ignored_idx is not None:
+                return ignored_idx
+        return torch.tensor(ignored_tokens or [], dtype=torch.long, device=DEVICE)
 
 class GeneratorLoss(nn.Module):
     def __init__(self):
         super().__init__()
 
-    def forward(self, prediction, x, rewards):
+    def forward(self, log_prediction, x, rewards):
         '''
         dimension calculation:
          x: dim(batch, seq_length)
          x1 = reshape(x): dim(batch * seq_length), 1-dimensional vector
-         x2 = one_hot(x1): dim(batch * seq_length, vocab_size), 2-dimensional
-         g_predictions: dim(batch, seq_length, vocab_size), 3-dimensional
-         pred1 = reshape(g_predictions): dim(batch * seq_length, vocab_size), 
+         g_log_predictions: dim(batch, seq_length, vocab_size), 3-dimensional,
+             log probabilities (output of log_softmax)
+         pred1 = reshape(g_log_predictions): dim(batch * seq_length, vocab_size), 
              2-dimensional
-         pred2 = log(clip_by_value(pred1)): dim(batch * seq_length, vocab_size)
-         reduced_pred = reduce_sum(x * pred2, axis=1): dim(batch * seq_length), 
-             1-dim vector, summed along axis=1
+         reduced_pred = gather(pred1, x1): dim(batch * seq_length), log 
+             probability of the actual token, picked by index instead of 
+             multiplying with a one_hot(x1) of dim(batch * seq_length, vocab_size),
+             clipped at log(1e-20)
          rewards: dim(batch, seq_length)
          reshaped_rewards = reshape(rewards): dim(batch * seq_length)
          g_loss = -reduce_sum(reduced_pred * reshaped_rewards): 
@@ -114,21 +208,26 @@ class GeneratorLoss(nn.Module):
              g_loss reduces to one single value.
         '''
         x1 = x.view(-1,1).long()
-        pred1 = prediction.view(-1,prediction.shape[-1])
-        x2 = self.createOneHotDummy(dim=(x1.shape[0],pred1.shape[1])).scatter_(1,x1,1)
-
-        pred2 = torch.log(torch.clamp(pred1, min=1e-20, max=1.0))
-        prod = torch.mul(x2,pred2)
-        reduced_prod = torch.sum(prod, dim=1)
+        # one explicit copy (only if needed) at this point, instead of implicit
+        #   copies further down for non-contiguous inputs.
+        log_prediction = log_prediction.contiguous()
+        pred1 = log_prediction.reshape(-1,log_prediction.shape[-1])
+        # keep the former clip_by_value(1e-20) floor, so that masked tokens
+        #   (e.g. the 'START' token) neither dominate the loss nor the gradient.
+        reduced_prod = pred1.gather(1, x1).view(-1).clamp_(min=LOG_EPS)
         rewards_prod = torch.mul(reduced_prod, rewards.view(-1))
         generator_loss = torch.sum(rewards_prod)
         return generator_loss
-    
-    def createOneHotDummy(self, dim):
-        one_hot = torch.empty(dim, device=DEVICE)
-        return one_hot.zero_()
 
-def train_generator(model, x, reward, iter_n_gen=None, batch_size=1, sentence_lengths=None):
+def train_generator(model, x, reward, iter_n_gen=None, batch_size=1, sentence_lengths=None,
+                    accum_steps=1, return_probs=False, trace=False):
+    ''' returns the model, the output probabilities of the last epoch (only if
+        return_probs, otherwise None) and the sampled outputs of the last epoch.
+        with trace=True the lstmCore is traced once for the fixed 
+        (batch_size, SEQ_LENGTH) minibatch shape and used for this call only;
+        the generator itself is left unchanged.
+        tracing requires full-length sentences.
+    '''
     if len(x.shape) == 1:
         x = x.view(1,x.shape[0])
     rem = len(x) % batch_size
@@ -139,9 +238,20 @@ def train_generator(model, x, reward, iter_n_gen=None, batch_size=1, sentence_le
     if len(sentence_lengths) < len(x):
         sentence_lengths.extend([x.shape[1]] 
                                 * (len(x)-len(sentence_lengths)))
-    sentence_lengths = torch.tensor(sentence_lengths,device=DEVICE).long()
+    sentence_lengths = torch.tensor(sentence_lengths[0:len(x)],device=x.device).long()
     if reward is None:
-        reward = torch.tensor([1.0] * x.shape[0] * x.shape[1],device=DEVICE).view(x.shape)
+        reward = torch.ones(x.shape, dtype=torch.float32, device=x.device)
+    if x.device.type == 'cpu' and reward.device.type == 'cpu' and DEVICE.type == 'cuda':
+        # cpu data feeding a gpu: pinned minibatches, so that the host to device
+        #   copies can overlap with compute (only cpu tensors can be pinned). the sampler yields the index list of
+        #   a whole minibatch, so each batch is gathered in one go.
+        dataset = TensorDataset(x, reward[0:len(x)], sentence_lengths)
+        loader = DataLoader(dataset, batch_size=None, pin_memory=True,
+                            sampler=BatchSampler(SequentialSampler(dataset), batch_size, drop_last=True))
+    else:
+        # data already on its device: plain slices are free views.
+        loader = [(x[p:p+batch_size], reward[p:p+batch_size], sentence_lengths[p:p+batch_size])
+                  for p in range(0, len(x), batch_size)]
     if iter_n_gen is None:
         iter_n_gen = GEN_NUM_EPOCH
         
@@ -149,28 +259,53 @@ def train_generator(model, x, reward, iter_n_gen=None, batch_size=1, sentence_le
     optimizer = torch.optim.SGD(params, lr=0.01)
     log = openLog()
     log.write('    training generator: {}\n'.format(datetime.now()))
+    # allocated once and refilled in place for every minibatch.
+    hidden = model.pretrain_model.module.init_hidden(batch_size)
+    # checked once here: with only full-length sentences no lengths are passed
+    #   on, so the (compiled) lstmCore never has to inspect them per batch.
+    full_length = bool((sentence_lengths == x.shape[1]).all())
+    traced = None
+    if trace:
+        assert full_length, 'trace requires full-length sentences.'
+        traced = torch.jit.trace(model.pretrain_model.module,
+                                 (x[0:batch_size].to(DEVICE), hidden), strict=False)
+    y_prob_all = None
+    if return_probs:
+        y_prob_all = torch.empty(len(x), x.shape[1], model.pretrain_model.module.vocab_size, device=DEVICE)
     for epoch in range(iter_n_gen):
         pointer = 0
-        y_prob_all = []
         y_output_all = []
         epoch_loss = []
-        while pointer + batch_size <= len(x):
-            x_batch = x[pointer:pointer+batch_size]
-            r_batch = reward[pointer:pointer+batch_size]
-            s_length = sentence_lengths[pointer:pointer+batch_size]
-            hidden = model.pretrain_model.module.init_hidden(batch_size)
-            y_output, y_prob, loss_var = model(x=x_batch, hidden=hidden, rewards=r_batch, sentence_lengths=s_length)
-            optimizer.zero_grad()
-            loss_var.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
-            optimizer.step()
-            y_prob_all.append(y_prob)
+        n_batch = 0
+        optimizer.zero_grad(set_to_none=True)
+        for x_batch, r_batch, s_length in loader:
+            x_batch = x_batch.to(DEVICE, non_blocking=True)
+            r_batch = r_batch.to(DEVICE, non_blocking=True)
+            if full_length:
+                s_length = None
+            else:
+                s_length = s_length.to(DEVICE, non_blocking=True)
+            for h in hidden:
+                h.normal_()
+            y_output, y_prob, loss_var = model(x=x_batch, hidden=hidden, rewards=r_batch,
+                                               sentence_lengths=s_length, lstmCore=traced,
+                                               return_probs=return_probs)
+            # accumulate the gradients of accum_steps minibatches before each
+            #   optimizer step. the last minibatch of the epoch always steps.
+            (loss_var / accum_steps).backward()
+            n_batch = n_batch + 1
+            if n_batch % accum_steps == 0 or pointer + 2 * batch_size > len(x):
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
+                optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
+            if return_probs:
+                y_prob_all[pointer:pointer+batch_size] = y_prob.detach()
             y_output_all.append(y_output)  
             epoch_loss.append(loss_var.item())
             pointer = pointer + batch_size
         log.write('      epoch: '+str(epoch)+' loss: '+str(sum(epoch_loss)/len(epoch_loss))+'\n')
     log.close()
-    return ( model, torch.cat(y_prob_all), torch.cat(y_output_all).view(list(x.shape)) )
+    return ( model, y_prob_all, torch.cat(y_output_all).view(list(x.shape)) )
 
 
 def sanityCheck_GeneratorLoss(pretrain_result=None, batch_size=5):
@@ -188,7 +323,7 @@ def sanityCheck_GeneratorLoss(pretrain_result=None, batch_size=5):
     log = openLog('test.txt')
     log.write('\n\nTest generator.sanityCheck_GeneratorLoss: {}\n'.format(datetime.now())) 
     criterion = GeneratorLoss()
-    g_loss = criterion(y_pred_pretrain[0:batch_size,:,:], 
+    g_loss = criterion(torch.log(y_pred_pretrain[0:batch_size,:,:]), 
                       x[0:batch_size,:], test_reward[0:batch_size,:])  
     g_loss.backward()
     optimizer.step()
@@ -206,7 +341,8 @@ def sanityCheck_generator(model=None, batch_size=1, sample_size=5):
         model = Generator(pretrain_model=pretrain_result[0])
         log.write('  generator instantiated: {}\n'.format(datetime.now()))
         model.to(DEVICE)
-    model, y_prob_all, y_output_all = train_generator(model, x, reward=None, batch_size=batch_size)
+    model, y_prob_all, y_output_all = train_generator(model, x, reward=None, batch_size=batch_size,
+                                                      return_probs=True)
     log.write('  trained generator outputs:\n')
     log.write('    y_output_all shape: '+ str(y_output_all.shape) +'\n')
     log.write('    y_prob_all shape: '+ str(y_prob_all.shape) +'\n')
@@ -43,23 +43,27 @@ class LSTMCore(nn.Module):
         # sentence dim: (batch_size, maximum sentence length)        
         if len(sentence.shape) == 1:
             sentence = sentence.view(1,sentence.shape[0])
-        if sentence_lengths is None:
-            sentence_lengths = torch.LongTensor([sentence.shape[1]] * len(sentence))
         # pack_padded_sequence is not compatible with DataParallel.
         # it needs to be a cpu tensor, and in runtime the model's forward
         # does not slice the cpu tensor as it does the layer's input tensors.
         # work-around as of pytorch 0.4.1: transform the lengths to a cuda tensor 
         # BEFORE entering forward pass, and revert it to a cpu tensor or a list
         # before calling pack_padded_sequence.
-        sentence_lengths = sentence_lengths.type(torch.LongTensor)
-        if len(sentence_lengths) < len(sentence):
-            sentence_lengths = torch.cat([sentence_lengths, torch.LongTensor([sentence.shape[1]]
-                                    * (len(sentence)-len(sentence_lengths)))])     
+        if sentence_lengths is not None:
+            sentence_lengths = sentence_lengths.type(torch.LongTensor)
+            if len(sentence_lengths) < len(sentence):
+                sentence_lengths = torch.cat([sentence_lengths, torch.LongTensor([sentence.shape[1]]
+                                        * (len(sentence)-len(sentence_lengths)))])     
         embeds = self.embedding(sentence.long())
-        embeds = torch.nn.utils.rnn.pack_padded_sequence(embeds, sentence_lengths.to(torch.device('cpu')), batch_first=True)
         hidden0 = [x.permute(1,0,2).contiguous() for x in hidden]
-        lstm_out, hidden0 = self.lstm(embeds, hidden0)
-        lstm_out, _ = torch.nn.utils.rnn.pad_packed_sequence(lstm_out, batch_first=True, total_length=sentence.shape[1])
+        if sentence_lengths is None or bool((sentence_lengths == sentence.shape[1]).all()):
+            # uniform lengths: nothing to pack, the padded batch goes to the
+            #   (cudnn) lstm directly.
+            lstm_out, hidden0 = self.lstm(embeds, hidden0)
+        else:
+            embeds = torch.nn.utils.rnn.pack_padded_sequence(embeds, sentence_lengths, batch_first=True)
+            lstm_out, hidden0 = self.lstm(embeds, hidden0)
+            lstm_out, _ = torch.nn.utils.rnn.pad_packed_sequence(lstm_out, batch_first=True, total_length=sentence.shape[1])
         tag_space = self.hidden2tag(lstm_out)        
         tag_scores = self.logSoftmax(tag_space)
         return tag_scores, tag_space
@@ -121,30 +125,26 @@ def test_genMaxSample(model, start_token=0, batch_size=1):
     ''' test lstmCore's generation function '''
     log = openLog('test.txt')
     log.write('\n\nTest lstmCore.test_genMaxSample: {}'.format(datetime.now()))
+    lstmCore = model.module
+    y_all_max = torch.empty(batch_size, SEQ_LENGTH, dtype=torch.int32, device=DEVICE)
+    y_all_sample = torch.empty(batch_size, SEQ_LENGTH, dtype=torch.int32, device=DEVICE)
     with torch.no_grad():
-        y = [start_token] * batch_size
-        y_all_max = torch.tensor(y,device=DEVICE).int().view(-1,1)
-        hidden = model.module.init_hidden(len(y))
-        for i in range(SEQ_LENGTH-1):
-            x = torch.tensor(y,device=DEVICE).view([-1,1])
-            y_pred, _ = model(x, hidden, sentence_lengths=torch.tensor([1],device=DEVICE).long())
-            y_pred = y_pred[:,:,1:-1]
-            y_pred = y_pred.squeeze(dim=1)
-            # take the max
-            y = torch.argmax(y_pred,dim=1).float().view(-1,1)
-            y_all_max = torch.cat([y_all_max,y.int()],dim=1)
-        
-        y = [start_token] * batch_size
-        y_all_sample = torch.tensor(y,device=DEVICE).int().view(-1,1)
-        hidden = model.module.init_hidden(len(y))
-        for i in range(SEQ_LENGTH-1):
-            x = torch.tensor(y,device=DEVICE).view([-1,1])
-            y_pred, tag_space = model(x,hidden,sentence_lengths=torch.tensor([1],device=DEVICE).long())
-            # random choice based on probability distribution.
-            y_prob = F.softmax(tag_space, dim=2)
-            shape = (y_prob.shape[0],y_prob.shape[1])
-            y = y_prob.view(-1,y_prob.shape[-1]).multinomial(num_samples=1).float().view(shape)
-            y_all_sample = torch.cat([y_all_sample,y.int()],dim=1)
+        # one unpacked single-token lstm step for the whole batch per token,
+        #   instead of a packed call with sentence_lengths=[1]. hidden states are carried over.
+        for y_all, take_max in ((y_all_max, True), (y_all_sample, False)):
+            y_all[:,0] = start_token
+            hidden = tuple(h.permute(1,0,2).contiguous() for h in lstmCore.init_hidden(batch_size))
+            for i in range(SEQ_LENGTH-1):
+                embeds = lstmCore.embedding(y_all[:,i:i+1])
+                lstm_out, hidden = lstmCore.lstm(embeds, hidden)
+                tag_space = lstmCore.hidden2tag(lstm_out[:,0])
+                if take_max:
+                    # take the max, skipping the first and the last token.
+                    y = torch.argmax(tag_space[:,1:-1], dim=1) + 1
+                else:
+                    # random choice based on probability distribution.
+                    y = F.softmax(tag_space, dim=1).multinomial(num_samples=1).view(-1)
+                y_all[:,i+1] = y
     log.write('\n  lstmCore.test_genMaxSample SUCCESSFUL: {}\n'.format(datetime.now()))
     log.close()
     return y_all_max, y_all_sample
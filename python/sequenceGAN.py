@@ -87,8 +87,10 @@ def main(batch_size, num=None):
             #   The more times a [0,1] class (positive, real data)
             #   is returned, the higher the reward.
             rewards = getReward(samples, rollout, discriminator)
+            # generated samples are never padded, so they are trained with the
+            #   default full-length sentence_lengths (no sequence packing).
             (generator, y_prob_all, y_output_all) = train_generator(model=generator, x=samples,
-                    reward=rewards, iter_n_gen=1, batch_size=batch_size, sentence_lengths=sentence_lengths)
+                    reward=rewards, iter_n_gen=1, batch_size=batch_size)
 
         rollout.module.update_params(generator)
 